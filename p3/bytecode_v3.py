@@ -0,0 +1,382 @@
+import operator
+import sys
+
+from intbase import InterpreterBase
+from type_valuev3 import PYTHON_TYPES, Type, Value, create_value
+
+# Opcodes for the compiled form of a function body. They are small ints so the
+# interpreter's dispatch table hashes an int instead of comparing elem_type strings.
+LOAD_CONST = 0
+LOAD_VAR = 1
+STORE_VAR = 2
+BINOP = 3
+NEG = 4
+CALL = 5
+CALL_PRINT = 6
+CALL_INPUT = 7
+POP = 8
+JUMP = 9
+JUMP_IF_FALSE = 10
+RETURN = 11
+PUSH_SCOPE = 12
+POP_SCOPE = 13
+TRACE = 14
+BINOP_TYPED = 15
+CLEAR_SCOPE = 16
+NOT = 17
+BINOP_GUARDED = 18
+CALL_STATIC = 19
+JUMP_IF_FALSE_OR_POP = 20
+JUMP_IF_TRUE_OR_POP = 21
+TO_BOOL = 22
+JUMP_IF_TRUE = 23
+
+BIN_OPS = {"+", "-", "*", "/", "==", "!=", ">", ">=", "<", "<=", "||", "&&"}
+# only evaluate their right operand if the left one doesn't decide the result
+LOGICAL_OPS = {"&&": JUMP_IF_FALSE_OR_POP, "||": JUMP_IF_TRUE_OR_POP}
+
+# Operations whose operand types are known at compile time, mapped to the builtin
+# that computes them and the Type of the result. These are emitted as
+# BINOP_TYPED and skip the interpreter's type checks and OP_TO_LAMBDA lookups.
+TYPED_OPS = {
+    (Type.INT, Type.INT): {
+        "+": (operator.add, Type.INT),
+        "-": (operator.sub, Type.INT),
+        "*": (operator.mul, Type.INT),
+        "/": (operator.floordiv, Type.INT),
+        "<": (operator.lt, Type.BOOL),
+        "<=": (operator.le, Type.BOOL),
+        ">": (operator.gt, Type.BOOL),
+        ">=": (operator.ge, Type.BOOL),
+    },
+    (Type.STRING, Type.STRING): {
+        "==": (operator.eq, Type.BOOL),
+        "!=": (operator.ne, Type.BOOL),
+    },
+    (Type.BOOL, Type.BOOL): {
+        "==": (operator.eq, Type.BOOL),
+        "!=": (operator.ne, Type.BOOL),
+    },
+}
+TYPE_TO_PYTHON = {t: python_type for python_type, t in PYTHON_TYPES.items()}
+
+
+# Compiled body of a function or lambda: a flat list of opcodes plus a parallel
+# list holding each opcode's argument. Once compilation finishes, handlers holds
+# the interpreter's handler for each opcode (direct threaded code), and params
+# holds a (name, is_ref) pair per formal parameter
+class Code:
+    __slots__ = ("ops", "args", "handlers", "params")
+
+    def __init__(self):
+        self.ops = []
+        self.args = []
+        self.handlers = None
+        self.params = []
+
+    def emit(self, op, arg=None):
+        self.ops.append(op)
+        self.args.append(arg)
+        return len(self.ops) - 1
+
+    def here(self):
+        return len(self.ops)
+
+    def patch(self, index, arg):
+        self.args[index] = arg
+
+    def thread(self, dispatch):
+        self.handlers = [dispatch[op] for op in self.ops]
+
+
+# Inline cache for a LOAD_VAR or STORE_VAR: the frame its variable resolved to last
+# time, and the environment version it was found at. While the version is unchanged
+# the variable still resolves to that frame, so the frames needn't be searched again
+class VarCache:
+    __slots__ = ("name", "version", "frame")
+
+    def __init__(self, name):
+        self.name = name
+        self.version = -1
+        self.frame = None
+
+
+# Lowers the statements of a function's ast into a Code object, in one pass
+class Compiler:
+    NIL_VALUE = create_value(InterpreterBase.NIL_DEF)
+    # type of a variable whose assignments haven't been resolved yet
+    PENDING = object()
+
+    # dispatch maps each opcode to the interpreter method that executes it, and
+    # func_name_to_ast maps each function name to its definitions by param count
+    def __init__(self, dispatch, func_name_to_ast, trace_output=False):
+        self.dispatch = dispatch
+        self.func_name_to_ast = func_name_to_ast
+        self.trace_output = trace_output
+
+    # compiles a func/lambda node once and caches the result on the node itself.
+    # The body shares the frame the caller pushes for the parameters
+    def compile_function(self, func_ast):
+        code = getattr(func_ast, "code", None)
+        if code is None:
+            code = Code()
+            code.params = [
+                (formal_ast.get("name"), formal_ast.elem_type == InterpreterBase.REFARG_DEF)
+                for formal_ast in func_ast.get("args")
+            ]
+            self.var_types = self.__predict_var_types(func_ast)
+            self.__compile_statements(code, func_ast.get("statements"), 0)
+            code.emit(LOAD_CONST, Compiler.NIL_VALUE)
+            code.emit(RETURN, 0)
+            code.thread(self.dispatch)
+            func_ast.code = code
+        return code
+
+    # scopes is the number of block frames open at this point in the function,
+    # so a return knows how many to discard
+    def __compile_statements(self, code, statements, scopes):
+        for statement in statements:
+            if self.trace_output:
+                code.emit(TRACE, statement)
+            if statement.elem_type == InterpreterBase.FCALL_DEF:
+                self.__compile_call(code, statement)
+                code.emit(POP)
+            elif statement.elem_type == "=":
+                self.__compile_expr(code, statement.get("expression"))
+                code.emit(STORE_VAR, VarCache(statement.get("name")))
+            elif statement.elem_type == InterpreterBase.RETURN_DEF:
+                expr_ast = statement.get("expression")
+                if expr_ast is None:
+                    code.emit(LOAD_CONST, Compiler.NIL_VALUE)
+                else:
+                    self.__compile_expr(code, expr_ast)
+                code.emit(RETURN, scopes)
+            elif statement.elem_type == InterpreterBase.IF_DEF:
+                self.__compile_if(code, statement, scopes)
+            elif statement.elem_type == InterpreterBase.WHILE_DEF:
+                self.__compile_while(code, statement, scopes)
+
+    # only an assignment directly inside a block can create a variable in that
+    # block's frame, so blocks without one run in the enclosing frame
+    def __needs_scope(self, statements):
+        return any(statement.elem_type == "=" for statement in statements)
+
+    def __compile_block(self, code, statements, scopes):
+        if not self.__needs_scope(statements):
+            self.__compile_statements(code, statements, scopes)
+            return
+        code.emit(PUSH_SCOPE)
+        self.__compile_statements(code, statements, scopes + 1)
+        code.emit(POP_SCOPE)
+
+    def __compile_if(self, code, if_ast, scopes):
+        self.__compile_expr(code, if_ast.get("condition"))
+        jump_else = code.emit(JUMP_IF_FALSE)
+        self.__compile_block(code, if_ast.get("statements"), scopes)
+        else_statements = if_ast.get("else_statements")
+        if else_statements is None:
+            code.patch(jump_else, (code.here(), "if"))
+            return
+        jump_end = code.emit(JUMP)
+        code.patch(jump_else, (code.here(), "if"))
+        self.__compile_block(code, else_statements, scopes)
+        code.patch(jump_end, code.here())
+
+    # a body that needs its own frame gets one for the whole loop, emptied after
+    # every iteration, rather than a new frame per iteration. The condition is
+    # tested once before the loop and then again at the bottom of the body, which
+    # jumps back to the top itself, so an iteration dispatches no separate JUMP
+    def __compile_while(self, code, while_ast, scopes):
+        condition = while_ast.get("condition")
+        statements = while_ast.get("statements")
+        needs_scope = self.__needs_scope(statements)
+        if needs_scope:
+            code.emit(PUSH_SCOPE)
+            scopes += 1
+        self.__compile_expr(code, condition)
+        jump_end = code.emit(JUMP_IF_FALSE)
+        top = code.here()
+        self.__compile_statements(code, statements, scopes)
+        if needs_scope:
+            code.emit(CLEAR_SCOPE)
+        self.__compile_expr(code, condition)
+        code.emit(JUMP_IF_TRUE, (top, "while"))
+        code.patch(jump_end, (code.here(), "while"))
+        if needs_scope:
+            code.emit(POP_SCOPE)
+
+    def __compile_call(self, code, call_ast):
+        func_name = call_ast.get("name")
+        args = call_ast.get("args")
+        for arg in args:
+            self.__compile_expr(code, arg)
+        if func_name == "print":
+            code.emit(CALL_PRINT, len(args))
+        elif func_name == "inputi" or func_name == "inputs":
+            code.emit(CALL_INPUT, (func_name, len(args)))
+        else:
+            # names of the actual args that are plain variables, which are the
+            # only ones a ref parameter can bind to
+            var_names = [
+                arg.get("name") if arg.elem_type == InterpreterBase.VAR_DEF else None
+                for arg in args
+            ]
+            # a named function always takes precedence over a variable of the same
+            # name, so a call that matches one can be bound to it now
+            candidate_funcs = self.func_name_to_ast.get(func_name, {})
+            if len(args) in candidate_funcs:
+                code.emit(CALL_STATIC, (candidate_funcs[len(args)], var_names))
+            else:
+                code.emit(CALL, (call_ast, var_names))
+
+    def __compile_expr(self, code, expr_ast):
+        elem_type = expr_ast.elem_type
+        if elem_type == InterpreterBase.NIL_DEF:
+            code.emit(LOAD_CONST, Compiler.NIL_VALUE)
+        elif elem_type == InterpreterBase.INT_DEF:
+            code.emit(LOAD_CONST, expr_ast.get("val"))
+        elif elem_type == InterpreterBase.STRING_DEF:
+            code.emit(LOAD_CONST, expr_ast.get("val"))
+        elif elem_type == InterpreterBase.BOOL_DEF:
+            code.emit(LOAD_CONST, expr_ast.get("val"))
+        elif elem_type == InterpreterBase.LAMBDA_DEF:
+            # one Value per lambda expression, shared by everything it's bound to
+            code.emit(LOAD_CONST, Value(Type.FUNC, expr_ast))
+        elif elem_type == InterpreterBase.VAR_DEF:
+            code.emit(LOAD_VAR, VarCache(expr_ast.get("name")))
+        elif elem_type == InterpreterBase.FCALL_DEF:
+            self.__compile_call(code, expr_ast)
+        elif elem_type in LOGICAL_OPS:
+            self.__compile_logical(code, expr_ast)
+        elif elem_type in BIN_OPS:
+            self.__compile_expr(code, expr_ast.get("op1"))
+            self.__compile_expr(code, expr_ast.get("op2"))
+            typed_op = self.__typed_op(expr_ast)
+            guarded_op = self.__guarded_op(expr_ast)
+            if typed_op is not None:
+                code.emit(BINOP_TYPED, typed_op)
+            elif guarded_op is not None:
+                code.emit(BINOP_GUARDED, guarded_op)
+            else:
+                code.emit(BINOP, sys.intern(elem_type))
+        elif elem_type == InterpreterBase.NEG_DEF or elem_type == InterpreterBase.NOT_DEF:
+            self.__compile_expr(code, expr_ast.get("op1"))
+            code.emit(NEG if elem_type == InterpreterBase.NEG_DEF else NOT)
+        else:
+            code.emit(LOAD_CONST, Compiler.NIL_VALUE)
+
+    # the left operand's value is converted to a bool; if that decides the result
+    # it is left on the stack as the result, and otherwise the right operand's
+    # value, converted to a bool, replaces it
+    def __compile_logical(self, code, logical_ast):
+        oper = sys.intern(logical_ast.elem_type)
+        self.__compile_expr(code, logical_ast.get("op1"))
+        jump_end = code.emit(LOGICAL_OPS[oper])
+        right_ast = logical_ast.get("op2")
+        self.__compile_expr(code, right_ast)
+        if self.__static_type(right_ast) != Type.BOOL:
+            code.emit(TO_BOOL, oper)
+        code.patch(jump_end, (code.here(), oper))
+
+    def __typed_op(self, arith_ast, var_types=None):
+        operand_types = (
+            self.__static_type(arith_ast.get("op1"), var_types),
+            self.__static_type(arith_ast.get("op2"), var_types),
+        )
+        if Compiler.PENDING in operand_types:
+            return Compiler.PENDING
+        return TYPED_OPS.get(operand_types, {}).get(arith_ast.elem_type)
+
+    # a typed operation for operands that are only predicted to have those types,
+    # along with the Python types the interpreter must check before using it
+    def __guarded_op(self, arith_ast):
+        typed_op = self.__typed_op(arith_ast, self.var_types)
+        if typed_op is None:
+            return None
+        left_type = self.__static_type(arith_ast.get("op1"), self.var_types)
+        right_type = self.__static_type(arith_ast.get("op2"), self.var_types)
+        return (
+            typed_op[0],
+            TYPE_TO_PYTHON[left_type],
+            TYPE_TO_PYTHON[right_type],
+            sys.intern(arith_ast.elem_type),
+        )
+
+    # the Type an expression is guaranteed to evaluate to, or None if that is only
+    # known at run time. Given var_types, variables are assumed to have the Type
+    # predicted for them, and the result is only a prediction
+    def __static_type(self, expr_ast, var_types=None):
+        elem_type = expr_ast.elem_type
+        if elem_type == InterpreterBase.INT_DEF:
+            return Type.INT
+        if elem_type == InterpreterBase.STRING_DEF:
+            return Type.STRING
+        if elem_type == InterpreterBase.BOOL_DEF:
+            return Type.BOOL
+        if elem_type == InterpreterBase.VAR_DEF:
+            if var_types is None:
+                return None
+            return var_types.get(expr_ast.get("name"))
+        if elem_type == InterpreterBase.NEG_DEF:
+            op_type = self.__static_type(expr_ast.get("op1"), var_types)
+            if op_type is Compiler.PENDING or op_type == Type.INT:
+                return op_type
+            return None
+        if elem_type == InterpreterBase.NOT_DEF:
+            op_type = self.__static_type(expr_ast.get("op1"), var_types)
+            if op_type is Compiler.PENDING:
+                return op_type
+            if op_type in (Type.INT, Type.BOOL):
+                return Type.BOOL
+            return None
+        if elem_type in LOGICAL_OPS:
+            return Type.BOOL
+        if elem_type in BIN_OPS:
+            typed_op = self.__typed_op(expr_ast, var_types)
+            if typed_op is Compiler.PENDING:
+                return typed_op
+            if typed_op is not None:
+                return typed_op[1]
+        return None
+
+    # Predicts the Type of each variable the function assigns, from the types of the
+    # expressions assigned to it, or None where they disagree or can't be known.
+    # A callee or a ref parameter can still change a variable behind the function's
+    # back, so these predictions are only ever used behind a type check
+    def __predict_var_types(self, func_ast):
+        assignments = []
+        self.__collect_assignments(func_ast.get("statements"), assignments)
+        params = {formal_ast.get("name") for formal_ast in func_ast.get("args")}
+        var_types = {
+            var_name: Compiler.PENDING
+            for var_name, _ in assignments
+            if var_name not in params
+        }
+        changed = True
+        while changed:
+            changed = False
+            for var_name, expr_ast in assignments:
+                var_type = var_types.get(var_name)
+                if var_type is None:
+                    continue
+                assigned_type = self.__static_type(expr_ast, var_types)
+                if assigned_type is Compiler.PENDING or assigned_type == var_type:
+                    continue
+                var_types[var_name] = assigned_type if var_type is Compiler.PENDING else None
+                changed = True
+        return {
+            var_name: None if var_type is Compiler.PENDING else var_type
+            for var_name, var_type in var_types.items()
+        }
+
+    def __collect_assignments(self, statements, assignments):
+        for statement in statements:
+            if statement.elem_type == "=":
+                assignments.append((statement.get("name"), statement.get("expression")))
+            elif statement.elem_type == InterpreterBase.IF_DEF:
+                self.__collect_assignments(statement.get("statements"), assignments)
+                else_statements = statement.get("else_statements")
+                if else_statements is not None:
+                    self.__collect_assignments(else_statements, assignments)
+            elif statement.elem_type == InterpreterBase.WHILE_DEF:
+                self.__collect_assignments(statement.get("statements"), assignments)
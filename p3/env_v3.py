@@ -1,16 +1,30 @@
 # The EnvironmentManager class keeps a mapping between each variable name (aka symbol)
-# in a brewin program and the Value object, which stores a type, and a value.
+# in a brewin program and its value.
 class EnvironmentManager:
+    # returned by get() for an undefined symbol, since None is a valid value (nil)
+    UNDEFINED = object()
+
     def __init__(self):
         self.environment = [{}]
         self.ref_environment = [{}]
+        # changes whenever a symbol could start resolving to a different frame: when
+        # a frame is pushed, popped or emptied, or a symbol is added to one
+        self.version = 0
 
-    # returns a VariableDef object
+    # returns the symbol's value, or UNDEFINED
     def get(self, symbol):
         for env in reversed(self.environment):
             if symbol in env:
                 return env[symbol]
 
+        return EnvironmentManager.UNDEFINED
+
+    # returns the frame the symbol resolves to, or None
+    def frame_of(self, symbol):
+        for env in reversed(self.environment):
+            if symbol in env:
+                return env
+
         return None
 
     def get_ref(self, local):
@@ -27,25 +41,50 @@ class EnvironmentManager:
 
         # symbol not found anywhere in the environment
         self.environment[-1][symbol] = value
+        self.version += 1
 
+    # writes value through to the caller variable that the reference parameter local
+    # is bound to, and on through that variable if it is itself a reference parameter
     def ref_set(self, local, value):
-        if local in self.ref_environment[-1]: 
-            self.environment[-3][self.get_ref(local)] = value
-            return
+        target = self.get_ref(local)
+        while target is not None:
+            env, ref, caller_refs = target
+            env[ref] = value
+            target = caller_refs.get(ref)
+
+    # finds the frame holding the caller's variable ref, so a reference parameter
+    # bound to it can write straight into that frame
+    def ref_target(self, ref):
+        for env in reversed(self.environment):
+            if ref in env:
+                return (env, ref, self.ref_environment[-1])
+
+        return None
+
     # create a new symbol in the top-most environment, regardless of whether that symbol exists
     # in a lower environment
     def create(self, symbol, value):
         self.environment[-1][symbol] = value
+        self.version += 1
 
     def ref_create(self, local, ref):
         self.ref_environment[-1][local] = ref
     # used when we enter a nested block to create a new environment for that block
     def push(self):
         self.environment.append({})  # [{}] -> [{}, {}]
+        self.version += 1
 
     # used when we exit a nested block to discard the environment for that block
     def pop(self):
         self.environment.pop()
+        self.version += 1
+
+    # used when a loop body starts its next iteration, to discard the variables
+    # created by the previous one while reusing the same environment
+    def clear(self):
+        if self.environment[-1]:
+            self.environment[-1].clear()
+            self.version += 1
 
     def ref_push(self):
         self.ref_environment.append({})
@@ -1,15 +1,91 @@
-import copy
-from enum import Enum
+import operator
+import sys
 
 from brewparse import parse_program
+from bytecode_v3 import (
+    BINOP,
+    BINOP_GUARDED,
+    BINOP_TYPED,
+    CALL,
+    CALL_INPUT,
+    CALL_PRINT,
+    CALL_STATIC,
+    CLEAR_SCOPE,
+    JUMP,
+    JUMP_IF_FALSE,
+    JUMP_IF_FALSE_OR_POP,
+    JUMP_IF_TRUE,
+    JUMP_IF_TRUE_OR_POP,
+    LOAD_CONST,
+    LOAD_VAR,
+    NEG,
+    NOT,
+    POP,
+    POP_SCOPE,
+    PUSH_SCOPE,
+    RETURN,
+    STORE_VAR,
+    TO_BOOL,
+    TRACE,
+    Compiler,
+)
 from env_v3 import EnvironmentManager
 from intbase import InterpreterBase, ErrorType
-from type_valuev3 import Type, Value, create_value, get_printable
+from type_valuev3 import (
+    BOOL_TAG,
+    FUNC_TAG,
+    INT_TAG,
+    NIL_TAG,
+    STRING_TAG,
+    Type,
+    Value,
+    create_value,
+    func_node,
+    get_printable,
+    tag_of,
+)
 
 
-class ExecStatus(Enum):
-    CONTINUE = 1
-    RETURN = 2
+# Binary operations that need more than a single operator module builtin. Bools act
+# as 1 and 0 in arithmetic, except that dividing by false gives 0
+def int_div(x, y):
+    if type(y) is bool and not y:
+        return 0
+    return x // y
+
+
+def bool_div(x, y):
+    if type(y) is int and not x:
+        return 0
+    return int(x) // y
+
+
+# == and != between an int and another value compare their truthiness
+def int_eq(x, y):
+    return (x != 0) == (y != 0)
+
+
+def int_ne(x, y):
+    if type(y) is not int and type(y) is not bool:
+        return True
+    return (x == 0 and y == 1) or (x != 0 and y == 0)
+
+
+def bool_eq(x, y):
+    return (type(y) is bool or type(y) is int) and x == (y != 0)
+
+
+def bool_ne(x, y):
+    return (type(y) is not bool and type(y) is not int) or x == (y == 0)
+
+
+# functions are equal only if they are the same func or lambda node
+def func_eq(x, y):
+    return func_node(x) is func_node(y)
+
+
+def func_ne(x, y):
+    return func_node(x) is not func_node(y)
 
 
 # Main interpreter class
@@ -17,13 +93,57 @@ class Interpreter(InterpreterBase):
     # constants
     NIL_VALUE = create_value(InterpreterBase.NIL_DEF)
     TRUE_VALUE = create_value(InterpreterBase.TRUE_DEF)
-    BIN_OPS = {"+", "-", "*", "/", "==", "!=", ">", ">=", "<", "<=", "||", "&&"}
+    HALT = -1
+    ENTER = -2
+    EQUALITY_OPS = {"==", "!="}
+    INT_BOOL_OPS = {"+", "-", "*", "/"}
+    INT_BOOL_TAGS = {INT_TAG, BOOL_TAG}
+    # keyed by the tag of the left operand's type
+    OP_TO_LAMBDA = {
+        INT_TAG: {
+            "+": operator.add,
+            "-": operator.sub,
+            "*": operator.mul,
+            "/": int_div,
+            "==": int_eq,
+            "!=": int_ne,
+            "<": operator.lt,
+            "<=": operator.le,
+            ">": operator.gt,
+            ">=": operator.ge,
+        },
+        STRING_TAG: {
+            "+": operator.add,
+            "==": operator.eq,
+            "!=": operator.ne,
+        },
+        BOOL_TAG: {
+            "==": bool_eq,
+            "!=": bool_ne,
+            "+": operator.add,
+            "-": operator.sub,
+            "*": operator.mul,
+            "/": bool_div,
+        },
+        FUNC_TAG: {
+            "==": func_eq,
+            "!=": func_ne,
+        },
+        # nil is only equal to nil
+        NIL_TAG: {
+            "==": operator.is_,
+            "!=": operator.is_not,
+        },
+    }
 
     # methods
     def __init__(self, console_output=True, inp=None, trace_output=False):
         super().__init__(console_output, inp)
         self.trace_output = trace_output
-        self.__setup_ops()
+        # bound once here rather than building a super() object on every call
+        self.__error = super().error
+        self.__output = super().output
+        self.__get_input = super().get_input
 
     # run a program that's provided in a string
     # usese the provided Parser found in brewparse.py to parse the program
@@ -32,8 +152,12 @@ class Interpreter(InterpreterBase):
         ast = parse_program(program)
         self.env = EnvironmentManager()
         self.__set_up_function_table(ast)
+        self.compiler = Compiler(
+            Interpreter.DISPATCH, self.func_name_to_ast, self.trace_output
+        )
         main_func = self.__get_func_by_name("main", 0)
-        self.__run_statements(main_func.get("statements"))
+        self.env.push()
+        self.__execute(self.compiler.compile_function(main_func))
 
     def __set_up_function_table(self, ast):
         self.func_name_to_ast = {}
@@ -56,371 +180,361 @@ class Interpreter(InterpreterBase):
         if name not in self.func_name_to_ast:
             first_class = True
             assigned_func = self.env.get(name)
-            if assigned_func is not None:
-                try:
-                    name = assigned_func.get("name")
-                except:
-                    return assigned_func.value()
-            else:
-                super().error(ErrorType.NAME_ERROR, f"Function {name} not found")
+            if assigned_func is EnvironmentManager.UNDEFINED:
+                self.__error(ErrorType.NAME_ERROR, f"Function {name} not found")
+            if tag_of(assigned_func) != FUNC_TAG:
+                self.__error(ErrorType.TYPE_ERROR, f"Variable {name} is not a function")
+            if isinstance(assigned_func, Value):
+                return assigned_func.value()
+            name = assigned_func.get("name")
         candidate_funcs = self.func_name_to_ast[name]
         if len(candidate_funcs) > 1 and first_class:
-            super().error(
+            self.__error(
                 ErrorType.NAME_ERROR,
                 f"Function {name} has multiple definitions, must specify number of parameters",
             )
         if num_params not in candidate_funcs:
-            super().error(
+            self.__error(
                 ErrorType.NAME_ERROR,
                 f"Function {name} taking {num_params} params not found",
             )
         return candidate_funcs[num_params]
 
-    def __run_statements(self, statements):
-        self.env.push()
-        for statement in statements:
-            if self.trace_output:
-                print(statement)
-            status = ExecStatus.CONTINUE
-            if statement.elem_type == InterpreterBase.FCALL_DEF:
-                self.__call_func(statement)
-            elif statement.elem_type == "=":
-                self.__assign(statement)
-            elif statement.elem_type == InterpreterBase.RETURN_DEF:
-                status, return_val = self.__do_return(statement)
-            elif statement.elem_type == Interpreter.IF_DEF:
-                status, return_val = self.__do_if(statement)
-            elif statement.elem_type == Interpreter.WHILE_DEF:
-                status, return_val = self.__do_while(statement)
-
-            if status == ExecStatus.RETURN:
-                self.env.pop()
-                return (status, return_val)
-
-        self.env.pop()
-        return (ExecStatus.CONTINUE, Interpreter.NIL_VALUE)
-
-    def __call_func(self, call_node):
-
-        func_name = call_node.get("name")
-        if func_name == "print":
-            return self.__call_print(call_node)
-        if func_name == "inputi":
-            return self.__call_input(call_node)
-        if func_name == "inputs":
-            return self.__call_input(call_node)
-        try:
-            actual_args = call_node.get("args")
-            func_ast = self.__get_func_by_name(func_name, len(actual_args))
-            formal_args = func_ast.get("args")
-        except:
-            super().error(ErrorType.TYPE_ERROR, "Function call not found")
-
-        if len(actual_args) != len(formal_args):
-            super().error(
+    # runs a compiled function body until it returns, and gives back the returned value
+    # code.handlers already holds each opcode's handler, so there is no table lookup
+    # per instruction; the next handler to call is picked by the one before it.
+    # Calls between Brewin functions don't recurse into __execute: a call handler
+    # returns ENTER, and the caller's code and return pc wait on calls until the
+    # callee returns. All functions share one operand stack, so a callee's returned
+    # value is left on top of the caller's operands
+    def __execute(self, code):
+        halt = Interpreter.HALT
+        env = self.env
+        calls = []
+        stack = []
+        pc = 0
+        while True:
+            handlers = code.handlers
+            args = code.args
+            while pc >= 0:
+                pc = handlers[pc](self, args[pc], stack, pc)
+            if pc == halt:
+                if not calls:
+                    return stack.pop()
+                env.ref_pop()
+                env.pop()
+                code, pc = calls.pop()
+            else:
+                callee, return_pc = self.__call
+                calls.append((code, return_pc))
+                code = callee
+                pc = 0
+
+    # var_names holds, per actual arg, the variable name it reads or None
+    def __call_func(self, call_node, var_names, arg_values, return_pc):
+        func_ast = self.__get_func_by_name(call_node.get("name"), len(arg_values))
+        code = self.compiler.compile_function(func_ast)
+        if len(arg_values) != len(code.params):
+            self.__error(
                 ErrorType.NAME_ERROR,
-                f"Function {func_ast.get('name')} with {len(actual_args)} args not found",
+                f"Function {func_ast.get('name')} with {len(arg_values)} args not found",
             )
-        self.env.push()
-        self.env.ref_push()
-        for formal_ast, actual_ast in zip(formal_args, actual_args):
-            result = copy.deepcopy(self.__eval_expr(actual_ast))
-            arg_name = formal_ast.get("name")
-            if formal_ast.elem_type == InterpreterBase.REFARG_DEF:
-                self.env.create(arg_name, result)
-                self.env.ref_create(arg_name, actual_ast.get("name"))
-            else:
-                self.env.create(arg_name, result)
-        _, return_val = self.__run_statements(func_ast.get("statements"))
-        self.env.ref_pop()
-        self.env.pop()
-        return return_val
-
-    def __call_print(self, call_ast):
-        output = ""
-        for arg in call_ast.get("args"):
-            result = self.__eval_expr(arg)  # result is a Value object
-            output = output + get_printable(result)
-        super().output(output)
+        return self.__enter_func(code, var_names, arg_values, return_pc)
+
+    # binds the args to the function's parameters in a new frame, and has __execute
+    # run the function's body and then carry on from return_pc
+    def __enter_func(self, code, var_names, arg_values, return_pc):
+        env = self.env
+        ref_targets = [
+            env.ref_target(var_name) if is_ref and var_name is not None else None
+            for (_, is_ref), var_name in zip(code.params, var_names)
+        ]
+        env.push()
+        env.ref_push()
+        for (arg_name, _), value, ref_target in zip(code.params, arg_values, ref_targets):
+            env.create(arg_name, value)
+            if ref_target is not None:
+                env.ref_create(arg_name, ref_target)
+        self.__call = (code, return_pc)
+        return Interpreter.ENTER
+
+    def __call_print(self, arg_values):
+        self.__output("".join([get_printable(result) for result in arg_values]))
         return Interpreter.NIL_VALUE
 
-    def __call_input(self, call_ast):
-        args = call_ast.get("args")
-        if args is not None and len(args) == 1:
-            result = self.__eval_expr(args[0])
-            super().output(get_printable(result))
-        elif args is not None and len(args) > 1:
-            super().error(
+    def __call_input(self, func_name, arg_values):
+        if len(arg_values) == 1:
+            self.__output(get_printable(arg_values[0]))
+        elif len(arg_values) > 1:
+            self.__error(
                 ErrorType.NAME_ERROR, "No inputi() function that takes > 1 parameter"
             )
-        inp = super().get_input()
-        if call_ast.get("name") == "inputi":
-            return Value(Type.INT, int(inp))
-        if call_ast.get("name") == "inputs":
-            return Value(Type.STRING, inp)
-
-    def __assign(self, assign_ast):
-        var_name = assign_ast.get("name")
-        value_obj = self.__eval_expr(assign_ast.get("expression"))
-        self.env.set(var_name, value_obj)
-        if self.env.get_ref(var_name) is not None:
-            self.env.ref_set(var_name, value_obj)
-
-    def __eval_expr(self, expr_ast):
-        # print("here expr")
-        # print("type: " + str(expr_ast.elem_type))
-        if expr_ast.elem_type == InterpreterBase.NIL_DEF:
-            # print("getting as nil")
-            return Interpreter.NIL_VALUE
-        if expr_ast.elem_type == InterpreterBase.INT_DEF:
-            return Value(Type.INT, expr_ast.get("val"))
-        if expr_ast.elem_type == InterpreterBase.STRING_DEF:
-            # print("getting as str")
-            return Value(Type.STRING, expr_ast.get("val"))
-        if expr_ast.elem_type == InterpreterBase.BOOL_DEF:
-            return Value(Type.BOOL, expr_ast.get("val"))
-        if expr_ast.elem_type == InterpreterBase.LAMBDA_DEF:
-            return Value(Type.FUNC, expr_ast)
-        if expr_ast.elem_type == InterpreterBase.VAR_DEF:
-            var_name = expr_ast.get("name")
-            val = self.env.get(var_name)
-            if val is None:
-                super().error(ErrorType.NAME_ERROR, f"Variable {var_name} not found")
-            return val
-        if expr_ast.elem_type == InterpreterBase.FCALL_DEF:
-            return self.__call_func(expr_ast)
-        if expr_ast.elem_type in Interpreter.BIN_OPS:
-            return self.__eval_op(expr_ast)
-        if expr_ast.elem_type == Interpreter.NEG_DEF:
-            return self.__eval_unary(expr_ast, [Type.INT], lambda x: -1 * x)
-        if expr_ast.elem_type == Interpreter.NOT_DEF:
-            return self.__eval_unary(expr_ast, [Type.BOOL, Type.INT], lambda x: not x)
-
-
-
-    def __eval_op(self, arith_ast):
-        left_value_obj = self.__eval_expr(arith_ast.get("op1"))
-        right_value_obj = self.__eval_expr(arith_ast.get("op2"))
-        if not self.__compatible_types(
-            arith_ast.elem_type, left_value_obj, right_value_obj
-        ):
-            super().error(
+        inp = self.__get_input()
+        if func_name == "inputi":
+            return int(inp)
+        if func_name == "inputs":
+            return inp
+
+    def __eval_op(self, oper, left_value, right_value):
+        if not self.__compatible_types(oper, left_value, right_value):
+            self.__error(
                 ErrorType.TYPE_ERROR,
-                f"Incompatible types for {arith_ast.elem_type} operation",
+                f"Incompatible types for {oper} operation",
             )
-        if hasattr(left_value_obj, 'elem_type') and left_value_obj.elem_type != 'func' and arith_ast.elem_type not in self.op_to_lambda[left_value_obj.type()]:
-            super().error(
+        left_tag = tag_of(left_value)
+        f = Interpreter.OP_TO_LAMBDA[left_tag].get(oper)
+        if f is None:
+            self.__error(
                 ErrorType.TYPE_ERROR,
-                f"Incompatible operator {arith_ast.elem_type} for type {left_value_obj.elem_type}",
+                f"Incompatible operator {oper} for type {Type(left_tag)}",
             )
-        
-        elif hasattr(left_value_obj, 'elem_type') and left_value_obj.elem_type == 'func':
-            if arith_ast.elem_type not in self.op_to_lambda[Type.FUNC]:
-                super().error(
-                    ErrorType.TYPE_ERROR,
-                    f"Incompatible operator {arith_ast.elem_type} for type {left_value_obj.elem_type}",
-                )
-            f = self.op_to_lambda[Type.FUNC][arith_ast.elem_type]
-        else:
-            f = self.op_to_lambda[left_value_obj.type()][arith_ast.elem_type]
-        # print("here eval")
-        # print(arith_ast)
-        # print("evaluating " + str(left_value_obj.type()) + " " + str(arith_ast.elem_type))
-        # print("obj left: " + str(left_value_obj.value()))
-        return f(left_value_obj, right_value_obj)
+        return f(left_value, right_value)
 
     def __compatible_types(self, oper, obj1, obj2):
         # DOCUMENT: allow comparisons ==/!= of anything against anything
-        if oper in ["==", "!="]:
+        if oper in Interpreter.EQUALITY_OPS:
             return True
-        elif oper in ["&&", "||", "+", "-", "*", "/"]:
-            return (obj1.type() == Type.BOOL or obj1.type() == Type.INT) and (
-                obj2.type() == Type.BOOL or obj2.type() == Type.INT
+        elif oper in Interpreter.INT_BOOL_OPS:
+            return tag_of(obj1) in Interpreter.INT_BOOL_TAGS and (
+                tag_of(obj2) in Interpreter.INT_BOOL_TAGS
             )
-        return obj1.type() == obj2.type()
+        return tag_of(obj1) == tag_of(obj2)
 
-    def __eval_unary(self, arith_ast, t, f):
-        value_obj = self.__eval_expr(arith_ast.get("op1"))
-        if value_obj.type() not in t:
-            super().error(
+    # tags holds the tags of the types the operator accepts
+    def __eval_unary(self, oper, value, tags, f):
+        if tag_of(value) not in tags:
+            self.__error(
                 ErrorType.TYPE_ERROR,
-                f"Incompatible type for {arith_ast.elem_type} operation",
+                f"Incompatible type for {oper} operation",
             )
-        if len(t) == 2:
-            return Value(Type.BOOL, (bool)(f(value_obj.value())))
-        return Value(t[0], f(value_obj.value()))
-
-    def __setup_ops(self):
-        self.op_to_lambda = {}
-        # set up operations on integers
-        self.op_to_lambda[Type.INT] = {}
-        self.op_to_lambda[Type.INT]["+"] = lambda x, y: Value(
-            x.type(), x.value() + y.value() if y.type() == Type.INT else (x.value() + 1 if y.value() else x.value())
-        )
-        self.op_to_lambda[Type.INT]["-"] = lambda x, y: Value(
-            x.type(), x.value() - y.value() if y.type() == Type.INT else (x.value() - 1 if y.value() else x.value())
-        )
-        self.op_to_lambda[Type.INT]["*"] = lambda x, y: Value(
-            x.type(), x.value() * y.value() if y.type() == Type.INT else (x.value() * 1 if y.value() else 0)
+        if len(tags) == 2:
+            return (bool)(f(value))
+        return f(value)
+
+    # the truth value of an operand of && or ||
+    def __logical_operand(self, oper, value):
+        if type(value) is bool:
+            return value
+        if type(value) is int:
+            return value != 0
+        self.__error(
+            ErrorType.TYPE_ERROR,
+            f"Incompatible types for {oper} operation",
         )
-        self.op_to_lambda[Type.INT]["/"] = lambda x, y: Value(
-            x.type(), x.value() // y.value() if y.type() == Type.INT else (x.value() // 1 if y.value() else 0)
-        )
-        self.op_to_lambda[Type.INT]["=="] = lambda x, y: Value(
-            Type.BOOL, (x.type() == y.type() or y.type() == Type.BOOL) and 
-            ((x.value() != 0 and y.value() == True) or (x.value() == 0 and y.value() == False)) if y.type() == Type.BOOL else ((x.value() != 0 and y.value() != 0) or x.value() == 0 and y.value() == 0)
-        )
-        self.op_to_lambda[Type.INT]["!="] = lambda x, y: Value(
-            Type.BOOL, (x.type() != y.type() and y.type() != Type.BOOL) or ((x.value() == 0 and y.value() == True) or (x.value() != 0 and y.value() == False))
-        )
-        self.op_to_lambda[Type.INT]["&&"] = lambda x, y: Value(
-            Type.BOOL, (x.type() == y.type() or y.type() == Type.BOOL) and (bool)(x.value() and y.value())
-        )
-        self.op_to_lambda[Type.INT]["||"] = lambda x, y: Value(
-            Type.BOOL, (x.type() == y.type() or y.type() == Type.BOOL) and (bool)(x.value() or y.value())
-        )
-        self.op_to_lambda[Type.INT]["<"] = lambda x, y: Value(
-            Type.BOOL, x.value() < y.value()
-        )
-        self.op_to_lambda[Type.INT]["<="] = lambda x, y: Value(
-            Type.BOOL, x.value() <= y.value()
-        )
-        self.op_to_lambda[Type.INT][">"] = lambda x, y: Value(
-            Type.BOOL, x.value() > y.value()
-        )
-        self.op_to_lambda[Type.INT][">="] = lambda x, y: Value(
-            Type.BOOL, x.value() >= y.value()
-        )
-        #  set up operations on strings
-        self.op_to_lambda[Type.STRING] = {}
-        self.op_to_lambda[Type.STRING]["+"] = lambda x, y: Value(
-            x.type(), x.value() + y.value()
-        )
-        self.op_to_lambda[Type.STRING]["=="] = lambda x, y: Value(
-            Type.BOOL, x.value() == y.value()
-        )
-        self.op_to_lambda[Type.STRING]["!="] = lambda x, y: Value(
-            Type.BOOL, x.value() != y.value()
-        )
-        #  set up operations on bools
-        self.op_to_lambda[Type.BOOL] = {}
-        self.op_to_lambda[Type.BOOL]["&&"] = lambda x, y: Value(
-            x.type(), (x.type() == y.type() or y.type() == Type.INT) and (bool)(x.value() and y.value())
-        )
-        self.op_to_lambda[Type.BOOL]["||"] = lambda x, y: Value(
-            x.type(), (x.type() == y.type() or y.type() == Type.INT) and (bool)(x.value() or y.value())
-        )
-        self.op_to_lambda[Type.BOOL]["=="] = lambda x, y: Value(
-            Type.BOOL, (x.type() == y.type() or y.type() == Type.INT) and ((x.value() == True and y.value() != 0) or (x.value() == False and y.value() == 0))
-        )
-        self.op_to_lambda[Type.BOOL]["!="] = lambda x, y: Value(
-            Type.BOOL, (x.type() != y.type() and y.type() != Type.INT) or ((x.value() == True and y.value() == 0) or (x.value() == False and y.value() != 0))
-        )
-        self.op_to_lambda[Type.BOOL]["+"] = lambda x, y: Value(
-            Type.INT, 1 + y.value() if y.type() == Type.INT and x.value() 
-            else (y.value() if y.type() == Type.INT 
-                  else (1 + 1 if x.value() and y.value() 
-                        else (1 if x.value() ^ y.value() 
-                              else 0)))
-        )
-        self.op_to_lambda[Type.BOOL]["-"] = lambda x, y: Value(
-            Type.INT, 1 - y.value() if y.type() == Type.INT and x.value() 
-            else (-1 * y.value() if y.type() == Type.INT 
-                  else (0 if x.value() and y.value() 
-                        else (1 if x.value() and not y.value() 
-                              else (-1 if not x.value() and y.value() 
-                                    else 0))))
-        )
-        self.op_to_lambda[Type.BOOL]["*"] = lambda x, y: Value(
-            Type.INT, y.value() if y.type() == Type.INT and x.value() 
-            else (0 if y.type() == Type.INT 
-                  else (1 if x.value() and y.value() 
-                        else 0))
-        )
-        self.op_to_lambda[Type.BOOL]["/"] = lambda x, y: Value(
-            Type.INT, 1 // y.value() if y.type() == Type.INT and x.value() 
-            else (0 if y.type() == Type.INT 
-                  else (1 if x.value() and y.value() 
-                        else x.value() // y.value()))
-        )
-        self.op_to_lambda[Type.FUNC] = {}
-        self.op_to_lambda[Type.FUNC]["=="] = lambda x, y: Value(
-            Type.BOOL, x is y if hasattr(x, 'elem_type') and hasattr(y,'elem_type') 
-                else (x.value() is y.value() if hasattr(x, 'type') and hasattr(y, 'type') 
-                      else(x.value() is y if hasattr(x, 'type') and hasattr(y, 'elem_type') 
-                           else(x is y.value() if hasattr(x, 'elem_type') and hasattr(y, 'type')
-                                else (x is y))))
-        )
-        self.op_to_lambda[Type.FUNC]["!="] = lambda x, y: Value(
-            Type.BOOL, x is not y if hasattr(x, 'elem_type') and hasattr(y,'elem_type') 
-                else (x.value() is not y.value() if hasattr(x, 'type') and hasattr(y, 'type') 
-                      else(x.value() is not y if hasattr(x, 'type') and hasattr(y, 'elem_type') 
-                           else(x is not y.value() if hasattr(x, 'elem_type') and hasattr(y, 'type')
-                                else (x is not y))))
-        )
-        #  set up operations on nil
-        self.op_to_lambda[Type.NIL] = {}
-        self.op_to_lambda[Type.NIL]["=="] = lambda x, y: Value(
-            Type.BOOL, (x.type() == y.type() if hasattr(y, 'type') 
-                        else x.type() == y) or (x.value() == y.value() if hasattr(y, 'type') 
-                                                else x.value() == y)
-        )
-        self.op_to_lambda[Type.NIL]["!="] = lambda x, y: Value(
-            Type.BOOL, (x.type() != y.type() if hasattr(y, 'type') 
-                        else x.type() != y) or (x.value() != y.value() if hasattr(y, 'type') 
-                                                else x.value() != y)
+
+    # opcode handlers; each takes the opcode's argument, the operand stack and the
+    # current pc, and returns the pc of the next opcode to run
+    def __op_load_const(self, value, stack, pc):
+        stack.append(value)
+        return pc + 1
+
+    def __op_load_var(self, cache, stack, pc):
+        env = self.env
+        if cache.version != env.version:
+            frame = env.frame_of(cache.name)
+            if frame is None:
+                self.__error(ErrorType.NAME_ERROR, f"Variable {cache.name} not found")
+            cache.frame = frame
+            cache.version = env.version
+        stack.append(cache.frame[cache.name])
+        return pc + 1
+
+    def __op_store_var(self, cache, stack, pc):
+        env = self.env
+        var_name = cache.name
+        value = stack.pop()
+        if cache.version == env.version:
+            cache.frame[var_name] = value
+        else:
+            env.set(var_name, value)
+            cache.frame = env.frame_of(var_name)
+            cache.version = env.version
+        if env.get_ref(var_name) is not None:
+            env.ref_set(var_name, value)
+        return pc + 1
+
+    def __op_binop(self, oper, stack, pc):
+        right_value = stack.pop()
+        stack[-1] = self.__eval_op(oper, stack[-1], right_value)
+        return pc + 1
+
+    # operand types were proven by the compiler, so apply the builtin directly
+    def __op_binop_typed(self, typed_op, stack, pc):
+        f = typed_op[0]
+        right_value = stack.pop()
+        stack[-1] = f(stack[-1], right_value)
+        return pc + 1
+
+    # the compiler only predicted the operand types, so check them before taking
+    # the fast path and fall back to the full dynamic operation if they differ
+    def __op_binop_guarded(self, guarded_op, stack, pc):
+        f, left_type, right_type, oper = guarded_op
+        right_value = stack.pop()
+        left_value = stack[-1]
+        if type(left_value) is left_type and type(right_value) is right_type:
+            stack[-1] = f(left_value, right_value)
+        else:
+            stack[-1] = self.__eval_op(oper, left_value, right_value)
+        return pc + 1
+
+    def __op_neg(self, _, stack, pc):
+        stack[-1] = self.__eval_unary(
+            InterpreterBase.NEG_DEF, stack[-1], (INT_TAG,), lambda x: -1 * x
         )
+        return pc + 1
 
-    def __do_if(self, if_ast):
-        cond_ast = if_ast.get("condition")
-        result = self.__eval_expr(cond_ast)
-        if result.type() == Type.INT:
-            result = Value(Type.BOOL, result.value() != 0)
-        elif result.type() != Type.BOOL:
-            super().error(
+    def __op_not(self, _, stack, pc):
+        stack[-1] = self.__eval_unary(
+            InterpreterBase.NOT_DEF, stack[-1], (BOOL_TAG, INT_TAG), lambda x: not x
+        )
+        return pc + 1
+
+    def __op_call(self, call_site, stack, pc):
+        call_node, var_names = call_site
+        first_arg = len(stack) - len(var_names)
+        arg_values = stack[first_arg:]
+        del stack[first_arg:]
+        return self.__call_func(call_node, var_names, arg_values, pc + 1)
+
+    # the compiler already resolved the call to a named function with this many params
+    def __op_call_static(self, call_site, stack, pc):
+        func_ast, var_names = call_site
+        first_arg = len(stack) - len(var_names)
+        arg_values = stack[first_arg:]
+        del stack[first_arg:]
+        code = self.compiler.compile_function(func_ast)
+        return self.__enter_func(code, var_names, arg_values, pc + 1)
+
+    def __op_call_print(self, num_args, stack, pc):
+        first_arg = len(stack) - num_args
+        arg_values = stack[first_arg:]
+        del stack[first_arg:]
+        stack.append(self.__call_print(arg_values))
+        return pc + 1
+
+    def __op_call_input(self, name_and_num_args, stack, pc):
+        func_name, num_args = name_and_num_args
+        first_arg = len(stack) - num_args
+        arg_values = stack[first_arg:]
+        del stack[first_arg:]
+        stack.append(self.__call_input(func_name, arg_values))
+        return pc + 1
+
+    def __op_pop(self, _, stack, pc):
+        stack.pop()
+        return pc + 1
+
+    def __op_jump(self, target, stack, pc):
+        return target
+
+    def __op_jump_if_false(self, target_and_construct, stack, pc):
+        target, construct = target_and_construct
+        result = stack.pop()
+        if type(result) is int:
+            result = result != 0
+        elif type(result) is not bool:
+            self.__error(
                 ErrorType.TYPE_ERROR,
-                "Incompatible type for if condition",
+                f"Incompatible type for {construct} condition",
             )
-        if result.value():
-            statements = if_ast.get("statements")
-            status, return_val = self.__run_statements(statements)
-            return (status, return_val)
-        else:
-            else_statements = if_ast.get("else_statements")
-            if else_statements is not None:
-                status, return_val = self.__run_statements(else_statements)
-                return (status, return_val)
-
-        return (ExecStatus.CONTINUE, Interpreter.NIL_VALUE)
-
-    def __do_while(self, while_ast):
-        cond_ast = while_ast.get("condition")
-        run_while = Interpreter.TRUE_VALUE
-        while run_while.value():
-            run_while = self.__eval_expr(cond_ast)
-            if run_while.type() == Type.INT:
-                run_while = Value(Type.BOOL, run_while.value() != 0)
-            elif run_while.type() != Type.BOOL:
-                super().error(
-                    ErrorType.TYPE_ERROR,
-                    "Incompatible type for while condition",
-                )
-            if run_while.value():
-                statements = while_ast.get("statements")
-                status, return_val = self.__run_statements(statements)
-                if status == ExecStatus.RETURN:
-                    return status, return_val
-
-        return (ExecStatus.CONTINUE, Interpreter.NIL_VALUE)
-
-    def __do_return(self, return_ast):
-        expr_ast = return_ast.get("expression")
-        if expr_ast is None:
-            return (ExecStatus.RETURN, Interpreter.NIL_VALUE)
-        value_obj = copy.deepcopy(self.__eval_expr(expr_ast))
-        return (ExecStatus.RETURN, value_obj)
+        if result:
+            return pc + 1
+        return target
+
+    def __op_jump_if_true(self, target_and_construct, stack, pc):
+        target, construct = target_and_construct
+        result = stack.pop()
+        if type(result) is int:
+            result = result != 0
+        elif type(result) is not bool:
+            self.__error(
+                ErrorType.TYPE_ERROR,
+                f"Incompatible type for {construct} condition",
+            )
+        if result:
+            return target
+        return pc + 1
+
+    # the left operand of && decides the result only if it is false
+    def __op_jump_if_false_or_pop(self, target_and_oper, stack, pc):
+        target, oper = target_and_oper
+        if self.__logical_operand(oper, stack[-1]):
+            stack.pop()
+            return pc + 1
+        stack[-1] = False
+        return target
+
+    # the left operand of || decides the result only if it is true
+    def __op_jump_if_true_or_pop(self, target_and_oper, stack, pc):
+        target, oper = target_and_oper
+        if self.__logical_operand(oper, stack[-1]):
+            stack[-1] = True
+            return target
+        stack.pop()
+        return pc + 1
+
+    def __op_to_bool(self, oper, stack, pc):
+        stack[-1] = self.__logical_operand(oper, stack[-1])
+        return pc + 1
+
+    # the returned value stays on the stack for __execute to hand back
+    def __op_return(self, num_scopes, stack, pc):
+        for _ in range(num_scopes):
+            self.env.pop()
+        return Interpreter.HALT
+
+    def __op_push_scope(self, _, stack, pc):
+        self.env.push()
+        return pc + 1
 
+    def __op_pop_scope(self, _, stack, pc):
+        self.env.pop()
+        return pc + 1
+
+    def __op_clear_scope(self, _, stack, pc):
+        self.env.clear()
+        return pc + 1
+
+    def __op_trace(self, statement, stack, pc):
+        print(statement)
+        return pc + 1
+
+    DISPATCH = {
+        LOAD_CONST: __op_load_const,
+        LOAD_VAR: __op_load_var,
+        STORE_VAR: __op_store_var,
+        BINOP: __op_binop,
+        BINOP_TYPED: __op_binop_typed,
+        BINOP_GUARDED: __op_binop_guarded,
+        NEG: __op_neg,
+        NOT: __op_not,
+        CALL: __op_call,
+        CALL_STATIC: __op_call_static,
+        CALL_PRINT: __op_call_print,
+        CALL_INPUT: __op_call_input,
+        POP: __op_pop,
+        JUMP: __op_jump,
+        JUMP_IF_FALSE: __op_jump_if_false,
+        JUMP_IF_FALSE_OR_POP: __op_jump_if_false_or_pop,
+        JUMP_IF_TRUE: __op_jump_if_true,
+        JUMP_IF_TRUE_OR_POP: __op_jump_if_true_or_pop,
+        TO_BOOL: __op_to_bool,
+        RETURN: __op_return,
+        PUSH_SCOPE: __op_push_scope,
+        POP_SCOPE: __op_pop_scope,
+        CLEAR_SCOPE: __op_clear_scope,
+        TRACE: __op_trace,
+    }
+
+# Runs the Brewin program in the file named on the command line, or a small demo
+# program if none is given. The interpreter is plain Python with no C extensions,
+# so for long-running programs it can be run under PyPy, whose JIT traces
+# __execute's dispatch loop: pypy3 interpreterv3.py program.br
 def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as program_file:
+            Interpreter().run(program_file.read())
+        return
     program = 'func foo(ref x, delta) { /* x passed by reference, delta passed by value */\
   x = x + delta;\
   delta = 0;\
@@ -12,8 +12,14 @@ class Type(Enum):
     REFARG = 6
 
 
-# Represents a value, which has a type and its value
+# Brewin values are represented directly by Python objects: int for INT, bool for
+# BOOL, str for STRING and None for NIL. So small ints, true, false and nil are
+# always shared singletons and never allocated. A named function is its func node,
+# and only a lambda needs a Value wrapper around its ast. Values are never modified
+# in place, so they are shared freely rather than copied
 class Value:
+    __slots__ = ("t", "v")
+
     def __init__(self, type, value=None):
         self.t = type
         self.v = value
@@ -25,30 +31,60 @@ class Value:
         return self.t
 
 
+PYTHON_TYPES = {int: Type.INT, bool: Type.BOOL, str: Type.STRING, type(None): Type.NIL}
+
+# Integer tags for the Types, for the interpreter's run-time type checks. Type
+# members hash and compare through Enum's Python-level methods, plain ints don't
+INT_TAG = Type.INT.value
+BOOL_TAG = Type.BOOL.value
+STRING_TAG = Type.STRING.value
+NIL_TAG = Type.NIL.value
+FUNC_TAG = Type.FUNC.value
+PYTHON_TAGS = {python_type: t.value for python_type, t in PYTHON_TYPES.items()}
+
+
+# returns the Brewin Type of a value; anything that isn't a primitive is a function
+def type_of(val):
+    return PYTHON_TYPES.get(type(val), Type.FUNC)
+
+
+# returns the tag of a value's Brewin Type
+def tag_of(val):
+    return PYTHON_TAGS.get(type(val), FUNC_TAG)
+
+
+# the ast a function value refers to
+def func_node(val):
+    if isinstance(val, Value):
+        return val.value()
+    return val
+
+
 def create_value(val):
     if val == InterpreterBase.TRUE_DEF:
-        return Value(Type.BOOL, True)
+        return True
     elif val == InterpreterBase.FALSE_DEF:
-        return Value(Type.BOOL, False)
+        return False
     elif val == InterpreterBase.NIL_DEF:
-        return Value(Type.NIL, None)
+        return None
     elif val == InterpreterBase.FUNC_DEF:
         return Value(Type.FUNC, None)
     elif isinstance(val, str):
-        return Value(Type.STRING, val)
+        return val
     elif isinstance(val, int):
-        return Value(Type.INT, val)
+        return val
     else:
         raise ValueError("Unknown value type")
 
 
 def get_printable(val):
-    if val.type() == Type.INT:
-        return str(val.value())
-    if val.type() == Type.STRING:
-        return val.value()
-    if val.type() == Type.BOOL:
-        if val.value() is True:
+    val_type = type(val)
+    if val_type is int:
+        return str(val)
+    if val_type is str:
+        return val
+    if val_type is bool:
+        if val is True:
             return "true"
         return "false"
     return None